@@ -14,132 +14,622 @@ Author: Shumon Huque <shuque@gmail.com>
 import os
 import sys
 import socket
-import getopt
+import argparse
+import dataclasses
+from typing import Optional
+import array
+import itertools
+import functools
+import random
+import struct
+import asyncio
+import contextvars
 import dns.resolver
+import dns.asyncresolver
 import dns.message
-import dns.query
 import dns.rdatatype
+import dns.rdataclass
 import dns.rcode
 import dns.flags
+import dns.inet
+import dns.exception
+
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
 
 
 PROGNAME = os.path.basename(sys.argv[0])
 VERSION = "1.1.0"
 
-class Prefs:
-    """Configuration Preferences"""
-    TIMEOUT = 3                         # Timeout for each SOA query
-    RETRIES = 3                         # Max #SOA queries to try per server
-    ALLOWED_DRIFT = 0                   # Allowed difference in serial numbers
-    USE_TCP = False                     # Use TCP (-c to set to True)
-    WANT_DNSSEC = False                 # Use -z to make this True
-    NO_NSSET = False                    # Query official NS set (-n to negate)
-    MASTER = None                       # Master server name
-    MASTER_IP = None                    # Master server IP address
-    MASTER_SERIAL = None
-    ADDITIONAL = []                     # additional NS names to check
-    AF = socket.AF_UNSPEC               # v4=AF_INET, v6=AF_INET6
+@dataclasses.dataclass(frozen=True, slots=True)
+class Config:
+    """
+    Configuration Preferences. Fixed once the command line has been
+    parsed and, unless -4 or -6 was given, the host's IPv6 route probed.
+    """
+    base_timeout: float = 1             # Timeout for first SOA query attempt
+    max_timeout: float = 3              # Cap on timeout as it doubles (-t)
+    retries: int = 3                    # Max #SOA queries to try per server
+    allowed_drift: int = 0              # Allowed difference in serial numbers
+    use_tcp: bool = False               # Use TCP (-c to set to True)
+    want_dnssec: bool = False           # Use -z to make this True
+    no_nsset: bool = False              # Query official NS set (-n to negate)
+    master: Optional[str] = None        # Master server name
+    additional: tuple = ()              # additional NS names to check
+    af: int = socket.AF_UNSPEC          # v4=AF_INET, v6=AF_INET6
+    resolver: Optional[tuple] = None    # aiodns upstream resolvers (--resolver)
+    keepalive: float = 10               # Idle TCP connection lifetime
+    happy_eyeballs: bool = False        # Race address families per server
+    race_delay: float = 0.1             # Grace period for the losing family
+    zonefile: Optional[str] = None      # File listing zones to check (-Z)
+    concurrency: int = 200              # Max #zones checked at once with -Z
+    max_inflight: int = 256             # Max #servers being queried at once
+    ipv6_route: bool = True             # Host has an IPv6 route (probed)
+    fast_fail: bool = False             # Stop once serials are seen to differ
+
+
+DEFAULTS = Config()
 
 
 class Stats:
-    """Runtime stats"""
-    SERIAL_LIST = []
-    COUNT_NSIP = 0
+    """Runtime stats for one zone"""
+
+    def __init__(self):
+        self.serial_list = array.array('I')   # packed unsigned 32-bit serials
+        self.count_nsip = 0
+        self.master_ip = None                 # Master server IP address
+        self.master_serial = None
 
 
+# Header flags, record type and class tested on every response
+_QR = dns.flags.QR
+_AA = dns.flags.AA
+_TC = dns.flags.TC
+_SOA = dns.rdatatype.SOA
+_IN = dns.rdataclass.IN
+
 AF_TEXT = {
     socket.AF_UNSPEC : "Unspec",
     socket.AF_INET : "IPv4",
     socket.AF_INET6 : "IPv6",
 }
 
+# Output lines of the zone being checked by the current task
+_OUTPUT = contextvars.ContextVar('output', default=None)
 
-def send_query_tcp(msg, ipaddress, timeout=Prefs.TIMEOUT):
-    """send DNS query over TCP to given IP address"""
-    res = None
-    try:
-        res = dns.query.tcp(msg, ipaddress, timeout=timeout)
-    except dns.exception.Timeout:
-        print("WARN: TCP query timeout for {}".format(ipaddress))
-    return res
 
+def report(text):
+    """
+    Output text. While a zone is being checked, the text is held in the
+    zone's buffer and written out together with the zone's results.
+    """
+    lines = _OUTPUT.get()
+    if lines is None:
+        sys.stdout.write(text)
+    else:
+        lines.append(text)
 
-def send_query_udp(msg, ipaddress, timeout=Prefs.TIMEOUT, retries=Prefs.RETRIES):
-    """send DNS query over UDP to given IP address"""
-    gotresponse = False
-    res = None
-    while (not gotresponse) and (retries > 0):
-        retries -= 1
+
+class QueryTemplate:
+    """
+    A query message rendered to wire format once. Each send only patches
+    in a fresh message id, so repeated queries for the same question do
+    not rebuild or re-encode the message.
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+        self.qname = msg.question[0].name
+        self.wire = bytearray(msg.to_wire())
+
+    def render(self, msgid):
+        """return wire format of the query with the given message id"""
+        struct.pack_into('!H', self.wire, 0, msgid)
+        return bytes(self.wire)
+
+    def is_response(self, res):
+        """is res a response to this query? (message id is not checked)"""
+        return bool(res.flags & _QR) and res.question == self.msg.question
+
+
+def make_soa_query(zone, want_dnssec=False):
+    """return the QueryTemplate for the SOA query sent to every server"""
+    msg = dns.message.make_query(zone, _SOA, want_dnssec=want_dnssec)
+    msg.flags &= ~dns.flags.RD  # set RD=0
+    return QueryTemplate(msg)
+
+
+@functools.lru_cache(maxsize=None)
+def numeric_sockaddr(ipaddress):
+    """return (address family, socket address) for port 53 of ipaddress"""
+    family, _, _, _, sockaddr = socket.getaddrinfo(
+        ipaddress, 53, type=socket.SOCK_DGRAM,
+        flags=socket.AI_NUMERICHOST)[0]
+    return (family, sockaddr)
+
+
+class UDPReader:
+    """
+    A non-blocking UDP socket watched with loop.add_reader. Each time it
+    becomes readable, every datagram queued on it is drained into a
+    preallocated buffer and handed to the dispatcher.
+    """
+
+    def __init__(self, loop, family, dispatcher):
+        self.loop = loop
+        self.dispatcher = dispatcher
+        self.buffer = bytearray(65535)
+        self.view = memoryview(self.buffer)
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(('', 0))
+        try:
+            loop.add_reader(self.sock.fileno(), self.read_responses)
+        except NotImplementedError:
+            self.sock.close()
+            raise
+
+    def read_responses(self):
+        """Read all queued datagrams from the socket"""
+        while True:
+            try:
+                nbytes, sockaddr = self.sock.recvfrom_into(self.buffer)
+            except OSError:
+                return
+            self.dispatcher.dispatch(self.view[:nbytes], sockaddr)
+
+    def sendto(self, wire, sockaddr):
+        """send a datagram; a full send buffer counts as a lost datagram"""
+        try:
+            self.sock.sendto(wire, sockaddr)
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        """Close the socket"""
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    """
+    A UDP datagram endpoint, for event loops without add_reader (such
+    as the Windows proactor loop). The transport reads one datagram per
+    wakeup and hands it to the dispatcher.
+    """
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.transport = None
+        self.error = None                   # last error reported by sendto
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.dispatcher.dispatch(data, addr)
+
+    def error_received(self, exc):
+        self.error = exc
+
+    def sendto(self, wire, sockaddr):
+        """send a datagram, raising any error the transport reports"""
+        self.error = None
+        self.transport.sendto(wire, sockaddr)
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Close the transport"""
+        self.transport.close()
+
+
+class UDPDispatcher:
+    """
+    Send DNS queries over a single long-lived UDP socket per address
+    family, matching responses to outstanding queries by message id
+    and source address. The socket is a UDPReader where the event loop
+    supports add_reader, and a UDPProtocol endpoint otherwise.
+    """
+
+    def __init__(self):
+        self.endpoints = {}                 # address family -> endpoint task
+        self.pending = {}                   # (msgid, ip) -> (template, future)
+
+    async def open_endpoint(self, family):
+        """Open a UDP socket for family"""
+        loop = asyncio.get_running_loop()
+        try:
+            return UDPReader(loop, family, self)
+        except NotImplementedError:
+            (_, protocol) = await loop.create_datagram_endpoint(
+                lambda: UDPProtocol(self), family=family)
+            return protocol
+
+    async def get_endpoint(self, family):
+        """Return the UDP endpoint for family, creating it on first use"""
+        task = self.endpoints.get(family)
+        if task is None:
+            task = asyncio.ensure_future(self.open_endpoint(family))
+            self.endpoints[family] = task
+        return await asyncio.shield(task)
+
+    def dispatch(self, wire, sockaddr):
+        """
+        Hand a received datagram to the matching pending query. The
+        message id is read from the header first, so only datagrams
+        that some query is still waiting for are fully parsed.
+        """
+        if len(wire) < 12:
+            return
+        (msgid,) = struct.unpack_from('!H', wire)
+        entry = self.pending.get((msgid, sockaddr[0]))
+        if entry is None or entry[1].done():
+            return
+        try:
+            res = dns.message.from_wire(bytes(wire))
+        except dns.exception.DNSException:
+            return
+        template, future = entry
+        if template.is_response(res):
+            future.set_result(res)
+
+    async def query(self, template, ipaddress, base_timeout, max_timeout,
+                    retries):
+        """
+        send query to ipaddress and wait for the response, retransmitting
+        up to retries times in total. The timeout starts at base_timeout
+        and doubles after each attempt, up to max_timeout. Retransmissions
+        reuse the message id, so a late response to an earlier
+        transmission is still accepted.
+        """
+        (family, sockaddr) = numeric_sockaddr(ipaddress)
+        endpoint = await self.get_endpoint(family)
+        msgid = random.getrandbits(16)
+        while (msgid, sockaddr[0]) in self.pending:
+            msgid = random.getrandbits(16)
+        key = (msgid, sockaddr[0])
+        wire = template.render(msgid)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = (template, future)
         try:
-            res = dns.query.udp(msg, ipaddress, timeout=timeout)
-            gotresponse = True
+            for attempt in range(retries):
+                endpoint.sendto(wire, sockaddr)
+                try:
+                    return await asyncio.wait_for(
+                        asyncio.shield(future),
+                        min(base_timeout * 2 ** attempt, max_timeout))
+                except asyncio.TimeoutError:
+                    report("WARN: UDP query timeout for {}\n".format(ipaddress))
+        finally:
+            del self.pending[key]
+        raise dns.exception.Timeout(timeout=max_timeout)
+
+    def close(self):
+        """Close all endpoints"""
+        for task in self.endpoints.values():
+            if task.done() and not task.cancelled() and task.exception() is None:
+                task.result().close()
+            else:
+                task.cancel()
+        self.endpoints.clear()
+
+
+UDP = UDPDispatcher()
+
+
+class TCPConnection:
+    """
+    A TCP connection to a nameserver, over which multiple queries can
+    be pipelined (RFC 7766). Responses are matched to queries by message
+    id. The connection is closed after being idle for keepalive seconds.
+    """
+
+    def __init__(self, reader, writer, keepalive):
+        self.reader = reader
+        self.writer = writer
+        self.keepalive = keepalive
+        self.pending = {}                   # msgid -> (template, future)
+        self.closed = False
+        self.idle_timer = None
+        self.reader_task = asyncio.get_running_loop().create_task(
+            self.read_responses())
+
+    @classmethod
+    async def dial(cls, ipaddress, timeout, keepalive):
+        """open a TCP connection to port 53 of given IP address"""
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(ipaddress, 53), timeout)
+        except asyncio.TimeoutError:
+            raise dns.exception.Timeout(timeout=timeout) from None
+        return cls(reader, writer, keepalive)
+
+    async def read_responses(self):
+        """Read responses and hand them to the matching pending queries"""
+        try:
+            while True:
+                (length,) = struct.unpack('!H', await self.reader.readexactly(2))
+                wire = await self.reader.readexactly(length)
+                if length < 12:
+                    continue
+                (msgid,) = struct.unpack_from('!H', wire)
+                entry = self.pending.get(msgid)
+                if entry is None or entry[1].done():
+                    continue
+                try:
+                    res = dns.message.from_wire(wire)
+                except dns.exception.DNSException:
+                    continue
+                template, future = entry
+                if template.is_response(res):
+                    future.set_result(res)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self.close()
+
+    async def query(self, template, timeout):
+        """send query over this connection and wait up to timeout for the response"""
+        if self.closed:
+            raise ConnectionResetError("TCP connection closed")
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        key = random.getrandbits(16)
+        while key in self.pending:
+            key = random.getrandbits(16)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = (template, future)
+        try:
+            wire = template.render(key)
+            self.writer.write(struct.pack('!H', len(wire)) + wire)
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise dns.exception.Timeout(timeout=timeout) from None
+        finally:
+            del self.pending[key]
+            if not self.pending and not self.closed:
+                self.idle_timer = asyncio.get_running_loop().call_later(
+                    self.keepalive, self.close)
+
+    def close(self):
+        """Close the connection, failing any queries still pending on it"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.idle_timer:
+            self.idle_timer.cancel()
+        self.writer.close()
+        self.reader_task.cancel()
+        for (_, future) in self.pending.values():
+            if not future.done():
+                future.set_exception(
+                    ConnectionResetError("TCP connection closed"))
+
+
+class TCPPool:
+    """Pool of persistent TCP connections, one per nameserver address"""
+
+    def __init__(self, keepalive=DEFAULTS.keepalive):
+        self.connections = {}               # ip -> task yielding TCPConnection
+        self.keepalive = keepalive          # idle lifetime of new connections
+
+    def usable(self, task):
+        """Is the (possibly still pending) connection task usable?"""
+        if not task.done():
+            return True
+        return (not task.cancelled()) and task.exception() is None and \
+            not task.result().closed
+
+    async def query(self, template, ipaddress, timeout):
+        """send query to ipaddress over a pooled TCP connection"""
+        task = self.connections.get(ipaddress)
+        if task is None or not self.usable(task):
+            task = asyncio.get_running_loop().create_task(
+                TCPConnection.dial(ipaddress, timeout, self.keepalive))
+            self.connections[ipaddress] = task
+        conn = await asyncio.shield(task)
+        return await conn.query(template, timeout)
+
+    def close(self):
+        """Close all connections"""
+        for task in self.connections.values():
+            if task.done() and not task.cancelled() and task.exception() is None:
+                task.result().close()
+            else:
+                task.cancel()
+        self.connections.clear()
+
+
+TCP = TCPPool()
+
+
+async def send_query_tcp(msg, ipaddress, timeout=DEFAULTS.max_timeout):
+    """
+    send DNS query over TCP to given IP address, retrying once if it
+    times out or the connection is lost
+    """
+    for attempt in range(2):
+        try:
+            return await TCP.query(msg, ipaddress, timeout=timeout)
         except dns.exception.Timeout:
-            print("WARN: UDP query timeout for {}".format(ipaddress))
+            report("WARN: TCP query timeout for {}\n".format(ipaddress))
+        except ConnectionError:
+            if attempt > 0:
+                raise
+    return None
+
+
+async def send_query_udp(msg, ipaddress, base_timeout=DEFAULTS.base_timeout,
+                         max_timeout=DEFAULTS.max_timeout,
+                         retries=DEFAULTS.retries):
+    """send DNS query over UDP to given IP address"""
+    res = None
+    try:
+        res = await UDP.query(msg, ipaddress, base_timeout=base_timeout,
+                              max_timeout=max_timeout, retries=retries)
+    except dns.exception.Timeout:
+        pass
     return res
 
 
-def send_query(qname, qtype, ipaddress):
+async def send_query(msg, ipaddress, cfg):
     """send DNS query to given IP address"""
-    res = None
-    msg = dns.message.make_query(qname, qtype, want_dnssec=Prefs.WANT_DNSSEC)
-    msg.flags &= ~dns.flags.RD  # set RD=0
-    if Prefs.USE_TCP:
-        return send_query_tcp(msg, ipaddress, timeout=Prefs.TIMEOUT)
-    res = send_query_udp(msg, ipaddress,
-                         timeout=Prefs.TIMEOUT, retries=Prefs.RETRIES)
-    if res and (res.flags & dns.flags.TC):
-        print("WARN: response was truncated; retrying with TCP ..")
-        return send_query_tcp(msg, ipaddress, timeout=Prefs.TIMEOUT)
+    max_timeout = cfg.max_timeout
+    if cfg.use_tcp:
+        return await send_query_tcp(msg, ipaddress, timeout=max_timeout)
+    res = await send_query_udp(msg, ipaddress,
+                               base_timeout=cfg.base_timeout,
+                               max_timeout=max_timeout,
+                               retries=cfg.retries)
+    if res and (res.flags & _TC):
+        report("WARN: response was truncated; retrying with TCP ..\n")
+        return await send_query_tcp(msg, ipaddress, timeout=max_timeout)
     return res
 
 
-def get_serial(zone, nshost, nsip):
-    """get serial number of zone from given nameserver ip address"""
+_QUERY_SLOTS = None
+
+
+def get_query_slots(limit):
+    """Return the semaphore bounding concurrent server queries to limit"""
+    global _QUERY_SLOTS
+    if _QUERY_SLOTS is None:
+        _QUERY_SLOTS = asyncio.Semaphore(limit)
+    return _QUERY_SLOTS
+
+
+async def get_serial_async(msg, nshost, nsip, cfg,
+                           aa=_AA, tc=_TC, soa=_SOA, rdclass=_IN):
+    """get serial number from given nameserver ip address using SOA query msg"""
     serial = None
     try:
-        resp = send_query(zone, 'SOA', nsip)
+        async with get_query_slots(cfg.max_inflight):
+            resp = await send_query(msg, nsip, cfg)
     except socket.error as e_info:
-        print("ERROR: {} {}: socket: {}".format(nshost, nsip, e_info))
+        report("ERROR: {} {}: socket: {}\n".format(nshost, nsip, e_info))
         return None
     if resp is None:
-        print("ERROR: No answer from {} {}".format(nshost, nsip))
+        report("ERROR: No answer from {} {}\n".format(nshost, nsip))
     elif resp.rcode() != 0:
-        print("ERROR: {} {} rcode {}".format(nshost, nsip, resp.rcode()))
-    elif not resp.flags & dns.flags.AA:
-        print("ERROR: {} {} answer not authoritative".format(nshost, nsip))
-    elif resp.flags & dns.flags.TC:
-        print("ERROR: {} {} answer is truncated".format(nshost, nsip))
+        report("ERROR: {} {} rcode {}\n".format(nshost, nsip, resp.rcode()))
+    elif not resp.flags & aa:
+        report("ERROR: {} {} answer not authoritative\n".format(nshost, nsip))
+    elif resp.flags & tc:
+        report("ERROR: {} {} answer is truncated\n".format(nshost, nsip))
     else:
-        for rrset in resp.answer:
-            if rrset.rdtype == dns.rdatatype.SOA:
-                serial = rrset[0].serial
-                break
+        try:
+            rrset = resp.find_rrset(resp.answer, msg.qname, rdclass, soa)
+        except KeyError:
+            report("ERROR: {} {}: SOA record not found.\n".format(nshost, nsip))
         else:
-            print("ERROR: {} {}: SOA record not found.".format(nshost, nsip))
+            serial = rrset[0].serial
     return serial
 
 
-def print_info(serial, master_serial, nsname, nsip, masterip):
-    """Print serial number info for specified zone and server"""
+def sdiff(serial1, serial2):
+    """
+    Signed difference serial1 - serial2 of two SOA serial numbers,
+    using RFC 1982 serial number arithmetic (correct across wrap-around).
+    """
+    return ((serial1 - serial2 + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+
+def format_info(serial, master_serial, nsname, nsip, masterip):
+    """Return serial number info line for specified zone and server"""
     if masterip:
         if (serial is None) or (master_serial is None):
-            return
-        drift = master_serial - serial
+            return ""
         if nsip == masterip:
-            print("{:15d} [{:>9s}] {} {}".format(serial, "MASTER", nsname, nsip))
+            return f"{serial:15d} [{'MASTER':>9s}] {nsname} {nsip}\n"
+        drift = sdiff(master_serial, serial)
+        return f"{serial:15d} [{drift:9d}] {nsname} {nsip}\n"
+    return f"{serial:15d} {nsname} {nsip}\n"
+
+
+_ARESOLVER = None
+
+
+def get_aresolver(cfg):
+    """Return the shared aiodns resolver, creating it on first use"""
+    global _ARESOLVER
+    if _ARESOLVER is None:
+        _ARESOLVER = aiodns.DNSResolver(nameservers=list(cfg.resolver),
+                                        timeout=cfg.max_timeout)
+    return _ARESOLVER
+
+
+async def close_aresolver():
+    """Release the aiodns resolver; it is bound to the running event loop"""
+    global _ARESOLVER
+    if _ARESOLVER is not None:
+        if asyncio.iscoroutinefunction(getattr(_ARESOLVER, 'close', None)):
+            await _ARESOLVER.close()
         else:
-            print("{:15d} [{:9d}] {} {}".format(serial, drift, nsname, nsip))
-    else:
-        print("{:15d} {} {}".format(serial, nsname, nsip))
-    return
+            _ARESOLVER.cancel()
+        _ARESOLVER = None
+
+
+async def query_aiodns(resolver, qname, qtype):
+    """return addresses of given type for qname via aiodns"""
+    if hasattr(resolver, 'query_dns'):             # aiodns 4.0 and later
+        result = await resolver.query_dns(qname, qtype)
+        rdtype = dns.rdatatype.from_text(qtype)
+        return [rr.data.addr for rr in result.answer if rr.type == rdtype]
+    return [x.host for x in await resolver.query(qname, qtype)]
+
 
+async def get_ip_aiodns(nsname, address_family, cfg):
+    """obtain list of IP addresses for given nameserver name via aiodns"""
+    qtypes = []
+    if address_family in (socket.AF_UNSPEC, socket.AF_INET6):
+        qtypes.append('AAAA')
+    if address_family in (socket.AF_UNSPEC, socket.AF_INET):
+        qtypes.append('A')
+    resolver = get_aresolver(cfg)
+    results = await asyncio.gather(
+        *(query_aiodns(resolver, nsname, qtype) for qtype in qtypes),
+        return_exceptions=True)
 
-def get_ip(nsname, address_family=Prefs.AF):
-    """obtain list of IP addresses for given nameserver name"""
     nsip_list = []
+    for result in results:
+        if not isinstance(result, Exception):
+            nsip_list.extend(result)
+    if not nsip_list:
+        _ = sys.stderr.write("WARNING: aiodns(%s): %s failed\n" % \
+                             (nsname, AF_TEXT[address_family]))
+    return nsip_list
+
+
+async def lookup_ip_async(nsname, cfg):
+    """
+    look up IP addresses for given nameserver name, asynchronously.
+    Addresses given literally are used as is. Names are only looked up
+    in IPv4 if the host has no IPv6 route and no family was chosen.
+    """
     try:
-        ai_list = socket.getaddrinfo(nsname, 53,
-                                     address_family, socket.SOCK_DGRAM)
+        family = dns.inet.af_for_address(nsname)
+    except ValueError:
+        pass
+    else:
+        if cfg.af in (socket.AF_UNSPEC, family):
+            return [nsname]
+        return []
+
+    address_family = cfg.af
+    if address_family == socket.AF_UNSPEC and not cfg.ipv6_route:
+        address_family = socket.AF_INET
+    if cfg.resolver:
+        return await get_ip_aiodns(nsname, address_family, cfg)
+    nsip_list = []
+    try:
+        ai_list = await asyncio.get_running_loop().getaddrinfo(
+            nsname, 53, family=address_family, type=socket.SOCK_DGRAM,
+            flags=socket.AI_ADDRCONFIG)
     except socket.gaierror:
         _ = sys.stderr.write("WARNING: getaddrinfo(%s): %s failed\n" % \
                              (nsname, AF_TEXT[address_family]))
@@ -149,126 +639,477 @@ def get_ip(nsname, address_family=Prefs.AF):
     return nsip_list
 
 
-def check_all_ns(zone, nsname_list):
+_IP_CACHE = {}                          # (name, family) -> lookup task
+
+
+async def get_ip_async(nsname, cfg):
     """
-    Check all nameserver serials and print information about them.
-    Returns the number nameserver IP addresses and the list of
-    observed serial numbers.
+    obtain list of IP addresses for given nameserver name. Results are
+    cached for the rest of the run, and concurrent requests for the same
+    name share a single lookup.
+    """
+    key = (nsname.lower().rstrip('.'), cfg.af)
+    task = _IP_CACHE.get(key)
+    if task is None:
+        task = asyncio.ensure_future(lookup_ip_async(nsname, cfg))
+        _IP_CACHE[key] = task
+    return list(await asyncio.shield(task))
+
+
+async def get_ip_table(nsname_list, cfg):
+    """
+    Resolve all given nameserver names concurrently. Returns a dict
+    mapping each name to its list of IP addresses.
+    """
+
+    ip_lists = await asyncio.gather(
+        *(get_ip_async(nsname, cfg) for nsname in nsname_list),
+        return_exceptions=True)
+    ip_table = {}
+    for (nsname, result) in zip(nsname_list, ip_lists):
+        if isinstance(result, Exception):
+            _ = sys.stderr.write("WARNING: address lookup of %s failed: %s\n" % \
+                                 (nsname, result))
+            result = []
+        ip_table[nsname] = result
+    return ip_table
+
+
+ABANDONED = object()                    # result of an abandoned query
+
+
+async def race_families(msg, nsname, nsip_list, cfg):
+    """
+    Query all addresses of nsname concurrently. Once one returns a
+    serial, queries to addresses of the other address family that are
+    still outstanding cfg.race_delay seconds later are abandoned.
+    Returns the serials in nsip_list order, ABANDONED for abandoned ones.
     """
 
+    if not nsip_list:
+        return []
+    tasks = [asyncio.ensure_future(get_serial_async(msg, nsname, nsip, cfg))
+             for nsip in nsip_list]
+    try:
+        pending = set(tasks)
+        winner = None
+        while pending and winner is None:
+            (done, pending) = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result() is not None:
+                    winner = nsip_list[tasks.index(task)]
+                    break
+
+        if pending:
+            (_, pending) = await asyncio.wait(pending, timeout=cfg.race_delay)
+        winner_v6 = winner is not None and ':' in winner
+        for task in pending:
+            nsip = nsip_list[tasks.index(task)]
+            if (':' in nsip) != winner_v6:
+                task.cancel()
+                report("WARN: abandoned query to {} {}\n".format(nsname, nsip))
+        await asyncio.wait(tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return [ABANDONED if task.cancelled() else (task.exception() or task.result())
+            for task in tasks]
+
+
+async def gather_until_diverged(*aws, zone, observed, allowed_drift):
+    """
+    Like asyncio.gather(*aws, return_exceptions=True), except that once
+    the serials in observed, which grows with every serial returned,
+    differ by more than allowed_drift, the outcome is decided and the
+    awaitables still outstanding are cancelled; their results are
+    ABANDONED. An awaitable may return a serial or a list of them.
+    """
+
+    tasks = [asyncio.ensure_future(x) for x in aws]
+    pending = set(tasks)
+    while pending:
+        (done, pending) = await asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                result = task.result()
+                for serial in result if isinstance(result, list) else [result]:
+                    if isinstance(serial, int):
+                        observed.add(serial)
+        if pending and serials_diverge(observed, allowed_drift):
+            report("WARN: {}: serials differ; abandoned {} queries\n".format(
+                zone, len(pending)))
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+            break
+    return [ABANDONED if task.cancelled() else (task.exception() or task.result())
+            for task in tasks]
+
+
+async def _run(zone, msg, nsname_list, ip_table, master_serial, master_ip,
+               cfg, abandoned=ABANDONED):
+    """
+    Query every address of every nameserver once (skipping the master's
+    address) and report their serials; return the number of addresses
+    checked and the serials observed
+    """
+
+    master = cfg.master
+
+    seen = {master_ip} if master_ip else set()
+    all_ips = []
     for nsname in nsname_list:
-        nsip_list = get_ip(nsname, Prefs.AF)
-        for nsip in nsip_list:
-            Stats.COUNT_NSIP += 1
-            serial = get_serial(zone, nsname, nsip)
-            if serial is not None:
-                Stats.SERIAL_LIST.append(serial)
-                print_info(serial, Prefs.MASTER_SERIAL, nsname, nsip,
-                           Prefs.MASTER_IP)
-
-
-def check_master(zone):
-    """Check master for zone"""
-
-    if Prefs.MASTER:
-        Prefs.MASTER_IP = get_ip(Prefs.MASTER, Prefs.AF)[0]
-        Stats.COUNT_NSIP += 1
-        Prefs.MASTER_SERIAL = get_serial(zone, Prefs.MASTER, Prefs.MASTER_IP)
-        if Prefs.MASTER_SERIAL is None:
-            print('ERROR: failed to obtain master serial')
-            sys.exit(3)
-        Stats.SERIAL_LIST.append(Prefs.MASTER_SERIAL)
-        print_info(Prefs.MASTER_SERIAL, Prefs.MASTER_SERIAL,
-                   Prefs.MASTER, Prefs.MASTER_IP, Prefs.MASTER_IP)
-
-
-def get_nsnames(zone):
+        for nsip in ip_table[nsname]:
+            if nsip not in seen:
+                seen.add(nsip)
+                all_ips.append((nsname, nsip))
+    count_nsip = len(all_ips)
+    serial_list = array.array('I')
+
+    gather = functools.partial(asyncio.gather, return_exceptions=True)
+    if cfg.fast_fail:
+        gather = functools.partial(
+            gather_until_diverged, zone=zone,
+            observed={master_serial} if master else set(),
+            allowed_drift=cfg.allowed_drift)
+
+    if cfg.happy_eyeballs:
+        groups = [(nsname, [nsip for (_, nsip) in group]) for (nsname, group)
+                  in itertools.groupby(all_ips, key=lambda x: x[0])]
+        results = await gather(
+            *(race_families(msg, nsname, nsip_list, cfg)
+              for (nsname, nsip_list) in groups))
+        serials = [serial
+                   for ((_, nsip_list), result) in zip(groups, results)
+                   for serial in (result if isinstance(result, list)
+                                  else [result] * len(nsip_list))]
+    else:
+        serials = await gather(
+            *(get_serial_async(msg, nsname, nsip, cfg)
+              for (nsname, nsip) in all_ips))
+
+    lines = []
+    if master:
+        lines.append(format_info(master_serial, master_serial, master,
+                                 master_ip, master_ip))
+    for ((nsname, nsip), serial) in zip(all_ips, serials):
+        if serial is abandoned:
+            count_nsip -= 1
+        elif isinstance(serial, Exception):
+            lines.append(f"ERROR: {nsname} {nsip}: {serial!r}\n")
+        elif serial is not None:
+            serial_list.append(serial)
+            lines.append(format_info(serial, master_serial, nsname, nsip,
+                                     master_ip))
+    report("".join(lines))
+    return (count_nsip, serial_list)
+
+
+async def check_all_ns(zone, msg, nsname_list, ip_table, stats, cfg):
+    """
+    Check all nameserver serials and print information about them.
+    SOA queries to every address of every nameserver are issued
+    concurrently. Results are printed in nameserver name order once
+    all have completed.
+    """
+
+    (count_nsip, serial_list) = await _run(
+        zone, msg, nsname_list, ip_table, stats.master_serial,
+        stats.master_ip, cfg)
+    stats.count_nsip += count_nsip
+    stats.serial_list.extend(serial_list)
+
+
+async def check_master(zone, msg, ip_table, stats, cfg):
+    """Check master for zone; return False if it failed to respond"""
+
+    master = cfg.master
+    if master:
+        if not ip_table[master]:
+            report('ERROR: {}: failed to obtain master address\n'.format(zone))
+            return False
+        stats.master_ip = ip_table[master][0]
+        stats.count_nsip += 1
+        stats.master_serial = await get_serial_async(msg, master,
+                                                     stats.master_ip, cfg)
+        if stats.master_serial is None:
+            report('ERROR: {}: failed to obtain master serial\n'.format(zone))
+            return False
+        stats.serial_list.append(stats.master_serial)
+    return True
+
+
+_RESOLVER = None
+
+
+def get_resolver(cfg):
+    """
+    Return the shared stub resolver, creating it on first use. It uses
+    the --resolver servers, if given, in place of the system ones.
+    """
+    global _RESOLVER
+    if _RESOLVER is None:
+        _RESOLVER = dns.asyncresolver.Resolver()
+        _RESOLVER.cache = dns.resolver.LRUCache()
+        if cfg.resolver:
+            _RESOLVER.nameservers = list(cfg.resolver)
+            _RESOLVER.rotate = True
+    return _RESOLVER
+
+
+async def get_nsnames(zone, cfg):
     """Get list of nameservers names to query"""
 
-    if Prefs.NO_NSSET:
-        if not Prefs.ADDITIONAL:
-            print("ERROR: -n requires specifying -a")
-            usage()
-        return Prefs.ADDITIONAL
+    if cfg.no_nsset:
+        return list(cfg.additional)
+
+    answers = await get_resolver(cfg).resolve(zone, dns.rdatatype.NS,
+                                              dns.rdataclass.IN)
+    return list(cfg.additional) + sorted([str(x.target) for x in answers.rrset])
+
 
-    answers = dns.resolver.resolve(zone, 'NS', 'IN')
-    return Prefs.ADDITIONAL + sorted([str(x.target) for x in answers.rrset])
+def serials_diverge(serials, allowed_drift):
+    """Do the given distinct serials differ by more than allowed_drift?"""
 
+    if len(serials) < 2:
+        return False
+    reference = next(iter(serials))
+    offsets = [sdiff(x, reference) for x in serials]
+    return (max(offsets) - min(offsets)) > allowed_drift
 
-def get_exit_code():
+
+def get_exit_code(stats, cfg):
     """Calculate exit code"""
 
-    if Stats.COUNT_NSIP != len(Stats.SERIAL_LIST):
+    if not stats.serial_list or stats.count_nsip != len(stats.serial_list):
         return 2
-    if Stats.SERIAL_LIST.count(Stats.SERIAL_LIST[0]) == len(Stats.SERIAL_LIST):
-        return 0
-    serial_range = max(Stats.SERIAL_LIST) - min(Stats.SERIAL_LIST)
-    if serial_range > Prefs.ALLOWED_DRIFT:
+    if serials_diverge(set(stats.serial_list), cfg.allowed_drift):
         return 1
     return 0
 
 
+def read_zonefile(filename):
+    """Read list of zones, one per line; blank and # comment lines ignored"""
+    try:
+        with open(filename) as zonefile:
+            lines = [line.split('#', 1)[0].strip() for line in zonefile]
+    except OSError as e_info:
+        print("ERROR: reading zone file: {}".format(e_info))
+        sys.exit(4)
+    return [line for line in lines if line]
+
+
+def name_list(value):
+    """argparse type for a comma separated list of names/addresses"""
+    return tuple(value.split(','))
+
+
+def address_list(value):
+    """argparse type for a comma separated list of IP addresses"""
+    addresses = name_list(value)
+    for address in addresses:
+        try:
+            dns.inet.af_for_address(address)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "{} is not an IP address".format(address)) from None
+    return addresses
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    """Argument parser that exits with status 4 on invocation errors"""
+
+    def error(self, message):
+        self.print_usage(sys.stderr)
+        self.exit(4, "{}: error: {}\n".format(self.prog, message))
+
+
+def make_parser():
+    """Return the command line parser"""
+
+    parser = ArgumentParser(
+        prog=PROGNAME,
+        description="{} version {}".format(PROGNAME, VERSION),
+        usage="%(prog)s [Options] <zone>\n"
+              "       %(prog)s [Options] -Z <zonefile>")
+    parser.add_argument("zone", nargs='?', help="zone to check")
+    family = parser.add_mutually_exclusive_group()
+    family.add_argument("-4", dest="af", action="store_const",
+                        const=socket.AF_INET, default=DEFAULTS.af,
+                        help="Use IPv4 transport only")
+    family.add_argument("-6", dest="af", action="store_const",
+                        const=socket.AF_INET6,
+                        help="Use IPv6 transport only")
+    parser.add_argument("-c", dest="use_tcp", action="store_true",
+                        help="Use TCP for queries "
+                             "(default: UDP with TCP on truncation)")
+    parser.add_argument("-t", dest="max_timeout", metavar="N", type=int,
+                        default=DEFAULTS.max_timeout,
+                        help="Max query timeout, backing off from {} sec "
+                             "(default %(default)s sec)".format(
+                                 DEFAULTS.base_timeout))
+    parser.add_argument("-r", dest="retries", metavar="N", type=int,
+                        default=DEFAULTS.retries,
+                        help="Maximum # SOA query retries for each server "
+                             "(default %(default)s)")
+    parser.add_argument("-d", dest="allowed_drift", metavar="N", type=int,
+                        default=DEFAULTS.allowed_drift,
+                        help="Allowed SOA serial number drift "
+                             "(default %(default)s)")
+    parser.add_argument("-m", dest="master", metavar="ns",
+                        help="Master server name/address to compare "
+                             "serial numbers with")
+    parser.add_argument("-a", dest="additional", metavar="ns1,..",
+                        type=name_list, default=DEFAULTS.additional,
+                        help="Specify additional nameserver names/addresses "
+                             "to query")
+    parser.add_argument("-z", dest="want_dnssec", action="store_true",
+                        help="Set DNSSEC-OK flag in queries "
+                             "(doesn't authenticate yet)")
+    parser.add_argument("-n", dest="no_nsset", action="store_true",
+                        help="Don't query advertised nameservers for the zone")
+    parser.add_argument("--resolver", metavar="ip1,..", type=address_list,
+                        help="Send NS queries to these resolvers, and "
+                             "resolve nameserver addresses via them with "
+                             "aiodns")
+    parser.add_argument("--happy-eyeballs", dest="happy_eyeballs",
+                        action="store_true",
+                        help="Once one address family of a server answers, "
+                             "abandon queries still outstanding to its "
+                             "other family")
+    parser.add_argument("-Z", dest="zonefile", metavar="file",
+                        help="Check every zone listed in file (one per line)")
+    parser.add_argument("--fast-fail", dest="fast_fail", action="store_true",
+                        help="Abandon outstanding queries once serials are "
+                             "known to differ by more than the allowed drift")
+    return parser
+
+
 def process_args(arg_vector):
-    """Process command line options and arguments"""
+    """Process command line options and arguments; return (config, zones)"""
+
+    parser = make_parser()
+    args = vars(parser.parse_args(arg_vector))
+    zone = args.pop("zone")
+    cfg = Config(**args)
+
+    if (zone is None) == (cfg.zonefile is None):
+        parser.error("specify exactly one of a zone or -Z zonefile")
+
+    if cfg.resolver and aiodns is None:
+        parser.error("--resolver requires the aiodns module")
+
+    if cfg.no_nsset and not cfg.additional:
+        parser.error("-n requires specifying -a")
+
+    if cfg.zonefile:
+        return (cfg, read_zonefile(cfg.zonefile))
+    return (cfg, [zone])
+
 
+async def audit_zone(zone, cfg):
+    """
+    Check the serial numbers of one zone; return its exit code. The NS
+    set lookup followed by the nameserver address lookups runs alongside
+    the master's address lookup followed by the master's SOA query.
+    """
+
+    stats = Stats()
     try:
-        (options, args) = getopt.getopt(arg_vector, '46ct:r:d:m:a:zn')
-    except getopt.GetoptError:
-        usage()
-
-    if len(args) != 1:
-        usage()
-
-    for (opt, optval) in options:
-        if opt == "-4":
-            Prefs.AF = socket.AF_INET
-        elif opt == "-6":
-            Prefs.AF = socket.AF_INET6
-        elif opt == "-c":
-            Prefs.USE_TCP = True
-        elif opt == "-z":
-            Prefs.WANT_DNSSEC = True
-        elif opt == "-n":
-            Prefs.NO_NSSET = True
-        elif opt == "-t":
-            Prefs.TIMEOUT = int(optval)
-        elif opt == "-r":
-            Prefs.RETRIES = int(optval)
-        elif opt == "-d":
-            Prefs.ALLOWED_DRIFT = int(optval)
-        elif opt == "-m":
-            Prefs.MASTER = optval
-        elif opt == "-a":
-            Prefs.ADDITIONAL = optval.split(',')
-
-    return args[0]
-
-
-def usage():
-    """Print usage string and terminate program."""
-    print("""\
-{0} version {1}
-Usage: {0} [Options] <zone>
-
-       Options:
-       -4          Use IPv4 transport only
-       -6          Use IPv6 transport only
-       -c          Use TCP for queries (default: UDP with TCP on truncation)
-       -t N        Query timeout value (default {2} sec)
-       -r N        Maximum # SOA query retries for each server (default {3})
-       -d N        Allowed SOA serial number drift (default {4})
-       -m ns       Master server name/address to compare serial numbers with
-       -a ns1,..   Specify additional nameserver names/addresses to query
-       -z          Set DNSSEC-OK flag in queries (doesn't authenticate yet)
-       -n          Don't query advertised nameservers for the zone
-""".format(PROGNAME, VERSION, Prefs.TIMEOUT, Prefs.RETRIES, Prefs.ALLOWED_DRIFT))
-    sys.exit(4)
+        msg = make_soa_query(zone, cfg.want_dnssec)
+    except dns.exception.DNSException as e_info:
+        report("ERROR: {}: bad zone name: {}\n".format(zone, e_info))
+        return 2
 
+    async def resolve_nsset():
+        nsname_list = await get_nsnames(zone, cfg)
+        return (nsname_list, await get_ip_table(nsname_list, cfg))
 
-if __name__ == '__main__':
+    async def resolve_master():
+        ip_table = await get_ip_table([cfg.master] if cfg.master else [], cfg)
+        return (ip_table, await check_master(zone, msg, ip_table, stats, cfg))
+
+    master_check = asyncio.ensure_future(resolve_master())
+    try:
+        (nsname_list, ip_table) = await resolve_nsset()
+    except dns.exception.DNSException as e_info:
+        master_check.cancel()
+        report("ERROR: {}: NS query failed: {}\n".format(zone, e_info))
+        return 2
+    except BaseException:
+        master_check.cancel()
+        raise
+    (master_table, master_ok) = await master_check
+    if not master_ok:
+        return 3
+    ip_table.update(master_table)
+    await check_all_ns(zone, msg, nsname_list, ip_table, stats, cfg)
+    return get_exit_code(stats, cfg)
+
+
+async def bulk(zones, cfg):
+    """
+    Check all given zones, at most cfg.concurrency of them at once. The
+    sockets, TCP connections and resolver caches are shared by all of
+    them. A zone whose check raises gets exit code 2; the others are
+    unaffected. Returns the highest exit code of any zone.
+    """
+
+    semaphore = asyncio.Semaphore(cfg.concurrency)
+
+    async def audit(zone):
+        async with semaphore:
+            lines = [f"; zone {zone}\n"] if cfg.zonefile is not None else []
+            _OUTPUT.set(lines)
+            try:
+                return await audit_zone(zone, cfg)
+            except Exception as e_info:
+                report("ERROR: {}: {!r}\n".format(zone, e_info))
+                return 2
+            finally:
+                sys.stdout.write("".join(lines))
 
-    ZONE = process_args(sys.argv[1:])
-    NSNAME_LIST = get_nsnames(ZONE)
-    check_master(ZONE)
-    check_all_ns(ZONE, NSNAME_LIST)
-    sys.exit(get_exit_code())
+    global _QUERY_SLOTS, _RESOLVER
+    TCP.keepalive = cfg.keepalive
+    try:
+        results = await asyncio.gather(*(audit(zone) for zone in zones))
+    finally:
+        UDP.close()
+        TCP.close()
+        await close_aresolver()
+        _QUERY_SLOTS = None
+        _RESOLVER = None
+        _IP_CACHE.clear()
+    return max(results, default=0)
+
+
+def have_ipv6(probe=("2001:4860:4860::8888", 53)):
+    """
+    Check whether this host has a route to the IPv6 Internet. Connecting
+    a UDP socket sends nothing; it only asks the kernel for a route.
+    """
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as s:
+            s.connect(probe)
+    except OSError:
+        return False
+    return True
+
+
+async def main(argv=None):
+    """
+    Check the zone(s) named by argv (default: the command line); return
+    exit code. Can be awaited from other programs.
+    """
+
+    (cfg, zones) = process_args(sys.argv[1:] if argv is None else argv)
+    if cfg.af == socket.AF_UNSPEC and not have_ipv6():
+        cfg = dataclasses.replace(cfg, ipv6_route=False)
+    return await bulk(zones, cfg)
+
+
+if __name__ == '__main__':
+    sys.stdout.reconfigure(line_buffering=False)
+    sys.exit(asyncio.run(main()))
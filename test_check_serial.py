@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+
+"""
+Tests for the serial number arithmetic and exit code logic of
+check_serial.py. Run with: python -m unittest test_check_serial
+"""
+
+import unittest
+
+from check_serial import Config, Stats, sdiff, serials_diverge, get_exit_code
+
+
+def make_stats(serials, count_nsip=None):
+    """return Stats holding the given serials from count_nsip servers"""
+    stats = Stats()
+    stats.serial_list.extend(serials)
+    stats.count_nsip = len(serials) if count_nsip is None else count_nsip
+    return stats
+
+
+class TestSdiff(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual(sdiff(105, 100), 5)
+        self.assertEqual(sdiff(100, 105), -5)
+        self.assertEqual(sdiff(100, 100), 0)
+
+    def test_wrap_around(self):
+        self.assertEqual(sdiff(0, 0xFFFFFFFF), 1)
+        self.assertEqual(sdiff(0xFFFFFFFF, 0), -1)
+        self.assertEqual(sdiff(3, 0xFFFFFFFE), 5)
+
+    def test_half_range(self):
+        self.assertEqual(sdiff(0x7FFFFFFF, 0), 0x7FFFFFFF)
+        self.assertEqual(sdiff(0x80000000, 0), -0x80000000)
+
+
+class TestSerialsDiverge(unittest.TestCase):
+
+    def test_single_serial(self):
+        self.assertFalse(serials_diverge(set(), 0))
+        self.assertFalse(serials_diverge({100}, 0))
+
+    def test_drift_limit(self):
+        self.assertTrue(serials_diverge({100, 101}, 0))
+        self.assertFalse(serials_diverge({100, 101}, 1))
+        self.assertFalse(serials_diverge({100, 103, 105}, 5))
+        self.assertTrue(serials_diverge({100, 103, 106}, 5))
+
+    def test_wrap_around(self):
+        self.assertFalse(serials_diverge({0xFFFFFFFF, 1}, 2))
+        self.assertTrue(serials_diverge({0xFFFFFFFF, 1}, 1))
+
+
+class TestGetExitCode(unittest.TestCase):
+
+    def test_identical(self):
+        self.assertEqual(get_exit_code(make_stats([7, 7, 7]), Config()), 0)
+
+    def test_differ(self):
+        self.assertEqual(get_exit_code(make_stats([7, 8]), Config()), 1)
+
+    def test_within_drift(self):
+        cfg = Config(allowed_drift=1)
+        self.assertEqual(get_exit_code(make_stats([7, 8]), cfg), 0)
+
+    def test_across_wrap_within_drift(self):
+        cfg = Config(allowed_drift=2)
+        stats = make_stats([0xFFFFFFFF, 1])
+        self.assertEqual(get_exit_code(stats, cfg), 0)
+
+    def test_empty(self):
+        self.assertEqual(get_exit_code(make_stats([]), Config()), 2)
+
+    def test_partial(self):
+        stats = make_stats([7, 7], count_nsip=3)
+        self.assertEqual(get_exit_code(stats, Config()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()